@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""
+staticrss_bench.py - Offline benchmark for the staticrss module
+Licensed under the Eiffel Forum License 2.
+
+Serves synthetic RSS, Atom and HTML documents from a local HTTP server and polls
+them with staticrss through a stub bot, so that scheduler and parser changes can
+be compared without hitting real sites:
+
+ python bench/staticrss_bench.py --feeds 200 --entries 50 --rounds 10
+
+The server supports ETag, Last-Modified and 304 responses, and can add latency
+and failures. Each round, a fraction of the feeds publishes new items. Reported
+are polls per second, CPU time per poll, peak memory and time-to-announce (from
+publishing an item on the server to the bot sending it). With --processes, CPU
+time and memory of the parser workers are read from /proc (Linux only) and
+reported separately and in the totals.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+import argparse
+import resource
+import threading
+import BaseHTTPServer
+import SocketServer
+import email.utils
+from cgi import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import willie.config # Willie expects its config and bot modules to be loaded first
+import staticrss
+
+
+class Document:
+	"""Synthetic feed whose newest items are first"""
+	
+	def __init__(self, name, format, entries, size):
+		self.name = name
+		self.format = format
+		self.entries = entries
+		self.padding = u'x' * size
+		self.count = entries
+		self.published = { } # item title -> time it appeared on the server
+		# Strictly increasing publication times, staticrss ignores items older than the newest
+		self.last = int(time.time()) - entries
+		self.dates = dict((i, self.last + i) for i in range(1, entries + 1))
+		self.last += entries
+		self.lock = threading.Lock()
+		self.update()
+	
+	
+	def title(self, i):
+		return u'Item {0}-{1}'.format(self.name, i)
+	
+	
+	def publish(self, count):
+		with self.lock:
+			now = time.time()
+			for i in range(count):
+				self.count += 1
+				self.published[self.title(self.count)] = now
+				self.last = max(int(now), self.last + 1)
+				self.dates[self.count] = self.last
+			self.update()
+	
+	
+	def update(self):
+		self.modified = email.utils.formatdate(time.time(), usegmt=True)
+		self.etag = '"{0}-{1}"'.format(self.name, self.count)
+		items = range(self.count, max(0, self.count - self.entries), -1)
+		if self.format == 'atom':
+			body = u''.join(
+				u'<entry><title>{0}</title><link href="/item/{1}"/><id>urn:{2}:{1}</id>'
+				u'<published>{4}</published><summary>{3}</summary></entry>'.format(
+				escape(self.title(i)), i, self.name, self.padding,
+				time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.dates[i]))) for i in items)
+			body = (u'<?xml version="1.0" encoding="utf-8"?>'
+			        u'<feed xmlns="http://www.w3.org/2005/Atom"><title>{0}</title>{1}</feed>').format(
+			        self.name, body)
+			self.type = 'application/atom+xml'
+		elif self.format == 'html':
+			body = u''.join(
+				u'<div class="post"><h2><a href="/item/{1}">{0}</a></h2><p>{2}</p></div>'.format(
+				escape(self.title(i)), i, self.padding) for i in items)
+			body = u'<html><body>{0}</body></html>'.format(body)
+			self.type = 'text/html'
+		else:
+			body = u''.join(
+				u'<item><title>{0}</title><link>/item/{1}</link><guid>urn:{2}:{1}</guid>'
+				u'<description>{3}</description></item>'.format(
+				escape(self.title(i)), i, self.name, self.padding) for i in items)
+			body = (u'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+			        u'<title>{0}</title>{1}</channel></rss>').format(self.name, body)
+			self.type = 'application/rss+xml'
+		self.body = body.encode('utf-8')
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	wbufsize = -1 # send each response in one piece, not one packet per header
+	
+	def log_message(self, format, *args):
+		pass
+	
+	def do_GET(self):
+	
+		server = self.server
+		server.requests += 1
+		
+		if server.latency:
+			time.sleep(server.latency)
+		
+		if server.failures and random.random() < server.failures:
+			server.failed += 1
+			self.send_response(503)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		
+		document = server.documents.get(self.path.lstrip('/'))
+		if document is None:
+			self.send_error(404)
+			return
+		
+		with document.lock:
+			(etag, modified, body, type) = (document.etag, document.modified,
+			                                document.body, document.type)
+		
+		if (server.validators and (self.headers.get('If-None-Match') == etag
+		    or self.headers.get('If-Modified-Since') == modified)):
+			server.not_modified += 1
+			self.send_response(304)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		
+		self.send_response(200)
+		self.send_header('Content-Type', type)
+		self.send_header('Content-Length', str(len(body)))
+		if server.validators:
+			self.send_header('ETag', etag)
+			self.send_header('Last-Modified', modified)
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+	daemon_threads = True
+	
+	def __init__(self, documents, latency, failures, validators):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+		self.documents = documents
+		self.latency = latency
+		self.failures = failures
+		self.validators = validators
+		self.requests = 0
+		self.failed = 0
+		self.not_modified = 0
+	
+	
+	def url(self, name):
+		return 'http://127.0.0.1:{0}/{1}'.format(self.server_address[1], name)
+
+
+class Section:
+	"""Config section that behaves like Willie's: missing options are None"""
+	
+	def __init__(self, **options):
+		self.__dict__.update(options)
+	
+	def __getattr__(self, name):
+		if name.startswith('__'):
+			raise AttributeError(name)
+		return None
+	
+	def get_list(self, name):
+		value = getattr(self, name)
+		if not value:
+			return [ ]
+		return value.split(',')
+
+
+class Config:
+
+	def __init__(self, sections):
+		self.sections = sections
+		self.core = Section(owner='owner', nick='bench', name='staticrss benchmark')
+	
+	def has_section(self, name):
+		return name in self.sections
+	
+	def __getattr__(self, name):
+		if name.startswith('__') or name not in self.sections:
+			raise AttributeError(name)
+		return self.sections[name]
+
+
+class Bot:
+	"""Just enough of a Willie bot for staticrss"""
+	
+	def __init__(self, sections, documents):
+		self.config = Config(sections)
+		self.memory = { }
+		self.privileges = { }
+		self.documents = documents
+		self.delays = [ ]
+		self.lines = 0
+		self.lock = threading.Lock()
+	
+	def msg(self, recipient, text, max_messages=1):
+		now = time.time()
+		with self.lock:
+			self.lines += 1
+			for message in text.split(staticrss.SEPARATOR):
+				(title, _, link) = message.partition(u' - ')
+				document = self.documents.get(title.split(u'-')[0][len(u'Item '):])
+				if document is not None and title in document.published:
+					self.delays.append(now - document.published.pop(title))
+
+
+def workers(data):
+	"""Process ids of the staticrss parser workers"""
+	pool = data.parser.pool
+	if pool is None:
+		return [ ]
+	return [ process.pid for process in pool._pool ]
+
+
+def worker_cpu(pids):
+	"""Seconds of CPU time used by the worker processes so far"""
+	ticks = float(os.sysconf('SC_CLK_TCK'))
+	total = 0.0
+	for pid in pids:
+		try:
+			with open('/proc/{0}/stat'.format(pid)) as handle:
+				fields = handle.read().rpartition(')')[2].split()
+		except IOError:
+			continue
+		total += (int(fields[11]) + int(fields[12])) / ticks # utime and stime
+	return total
+
+
+def worker_peak(pids):
+	"""Sum of the peak resident set sizes of the worker processes in MiB"""
+	total = 0.0
+	for pid in pids:
+		try:
+			with open('/proc/{0}/status'.format(pid)) as handle:
+				for line in handle:
+					if line.startswith('VmHWM:'):
+						total += int(line.split()[1]) / 1024.0
+		except IOError:
+			continue
+	return total
+
+
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(args):
+
+	formats = [ 'rss', 'atom', 'html' ] if args.format == 'mixed' else [ args.format ]
+	documents = { }
+	for i in range(args.feeds):
+		name = 'f{0}'.format(i)
+		documents[name] = Document(name, formats[i % len(formats)], args.entries, args.size)
+	
+	server = Server(documents, args.latency / 1000.0, args.failures, not args.no_validators)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	
+	state = tempfile.mkdtemp(prefix='staticrss-bench-')
+	
+	rss = Section(feeds=','.join(sorted(documents)), state=state, enable='#bench',
+	              interval='1', send_delay='0', watch=False,
+	              parse_processes=str(args.processes))
+	sections = { 'rss' : rss }
+	for (name, document) in documents.items():
+		section = Section(url=server.url(name))
+		if document.format == 'html':
+			section.soup_select = 'div.post'
+			section.title_select = 'h2 a'
+			section.link_select = 'h2 a @href'
+			if args.soup_parser:
+				section.soup_parser = args.soup_parser
+		if args.incremental:
+			section.incremental = str(args.incremental)
+		sections['rss_' + name] = section
+	
+	bot = Bot(sections, documents)
+	
+	try:
+	
+		start = time.time()
+		staticrss.setup(bot)
+		setup_time = time.time() - start
+		
+		data = bot.memory['staticrss']
+		data.loader.join()
+		load_time = time.time() - start
+		
+		# The first round only seeds the known items
+		for feed in data.feeds:
+			with data.lock:
+				feed.update(bot, 0, force=True)
+		
+		polls = 0
+		wall = 0.0
+		cpu = 0.0
+		workers_cpu = 0.0
+		for round in range(args.rounds):
+		
+			for document in random.sample(documents.values(),
+			                              int(len(documents) * args.publish)):
+				document.publish(random.randint(1, 3))
+			
+			usage = resource.getrusage(resource.RUSAGE_SELF)
+			pids = workers(data)
+			used = worker_cpu(pids)
+			start = time.time()
+			for feed in data.feeds:
+				with data.lock:
+					if feed.update(bot, 0, force=True):
+						polls += 1
+			wall += time.time() - start
+			after = resource.getrusage(resource.RUSAGE_SELF)
+			cpu += (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+			workers_cpu += worker_cpu(pids) - used
+		
+		data.announcer.stop()
+		
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+		workers_peak = worker_peak(workers(data))
+		
+		def per_poll(seconds):
+			return 1000.0 * seconds / polls if polls else 0
+		
+		lines = [
+			u'feeds={0} entries={1} size={2} format={3} rounds={4} latency={5}ms failures={6} processes={7}'.format(
+				args.feeds, args.entries, args.size, args.format, args.rounds,
+				args.latency, args.failures, args.processes),
+			u'setup: {0:.3f}s, state loaded after {1:.3f}s'.format(setup_time, load_time),
+			u'polls: {0} in {1:.2f}s = {2:.1f} polls/s'.format(polls, wall, polls / wall if wall else 0),
+			u'cpu: {0:.2f}ms per poll (main process {1:.2f}ms, parser workers {2:.2f}ms)'.format(
+				per_poll(cpu + workers_cpu), per_poll(cpu), per_poll(workers_cpu)),
+			u'peak memory: {0:.1f} MiB (main process {1:.1f} MiB, parser workers {2:.1f} MiB)'.format(
+				peak + workers_peak, peak, workers_peak),
+			u'server: {0} requests, {1} not modified, {2} failed'.format(
+				server.requests, server.not_modified, server.failed),
+			u'announce: {0} items in {1} lines, delay median {2:.3f}s p95 {3:.3f}s max {4:.3f}s'.format(
+				len(bot.delays), bot.lines, percentile(bot.delays, 0.5),
+				percentile(bot.delays, 0.95), max(bot.delays) if bot.delays else 0.0),
+			data.report(),
+		]
+		
+		return lines
+	
+	finally:
+		if 'staticrss' in bot.memory:
+			staticrss.shutdown(bot)
+		server.shutdown()
+		shutil.rmtree(state, ignore_errors=True)
+
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Offline staticrss benchmark')
+	parser.add_argument('--feeds', type=int, default=200, help='number of feeds')
+	parser.add_argument('--entries', type=int, default=50, help='entries per document')
+	parser.add_argument('--size', type=int, default=200, help='padding bytes per entry')
+	parser.add_argument('--format', choices=[ 'rss', 'atom', 'html', 'mixed' ], default='mixed')
+	parser.add_argument('--rounds', type=int, default=5, help='polls of every feed')
+	parser.add_argument('--publish', type=float, default=0.2,
+	                    help='fraction of feeds that publish new items each round')
+	parser.add_argument('--latency', type=float, default=0, help='server latency in ms')
+	parser.add_argument('--failures', type=float, default=0,
+	                    help='fraction of requests answered with 503')
+	parser.add_argument('--no-validators', action='store_true',
+	                    help='don\'t send ETag and Last-Modified headers')
+	parser.add_argument('--incremental', type=int, default=0,
+	                    help='use incremental parsing with this many known entries')
+	parser.add_argument('--processes', type=int, default=0,
+	                    help='parse in this many worker processes')
+	parser.add_argument('--soup-parser', help='BeautifulSoup parser for HTML feeds')
+	parser.add_argument('--seed', type=int, default=0, help='random seed')
+	parser.add_argument('--output', help='also append the report to this file')
+	args = parser.parse_args()
+	
+	random.seed(args.seed)
+	logging.basicConfig(level=logging.ERROR)
+	staticrss.logger.setLevel(logging.ERROR)
+	
+	lines = run(args)
+	
+	report = u'\n'.join(lines) + u'\n'
+	sys.stdout.write(report.encode('utf-8'))
+	if args.output:
+		with open(args.output, 'a') as handle:
+			handle.write(report.encode('utf-8') + '\n')
+
+
+if __name__ == '__main__':
+	main()
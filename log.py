@@ -5,11 +5,18 @@ Copyright © 2014, Daniel Scharrer, <daniel@constexpr.org>
 Licensed under the Eiffel Forum License 2.
 
 This module implements a simple channel log
+
+With segment_size set, each day's log is split into numbered segments of at most
+that many bytes (#channel.YYYY-MM-DD.NNN.log). Segments are preallocated and
+trimmed when closed. #channel.YYYY-MM-DD.manifest lists each segment with the
+time of its first line.
 """
 import time
 import os
 import re
 import codecs
+import ctypes
+import ctypes.util
 import threading
 import traceback
 import logging
@@ -22,6 +29,15 @@ from willie.config import ConfigurationError
 logger = logging.getLogger('pipe')
 logger.setLevel(logging.INFO)
 
+FALLOC_FL_KEEP_SIZE = 1
+
+try:
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+	fallocate.argtypes = [ ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong ]
+except (OSError, AttributeError):
+	fallocate = None
+
 def configure(config):
 	"""
 	| [log] | example | purpose |
@@ -29,11 +45,14 @@ def configure(config):
 	| exclude | #willie | A list of channels which should not be logged |
 	| enable | #willie | A whitelist of the only channels you want to log |
 	| path | /home/willie/logs | Base directory for log files |
+	| segment_size | 268435456 | Split daily logs into segments of this many bytes |
 	"""
 	if config.option('Configure log', False):
 		config.interactive_add('log', 'exclude', "A list of channels which should not be logged")
 		config.interactive_add('log', 'enable', "A whitelist of the only channels you want to log")
 		config.interactive_add('log', 'path', "Base directory for log files")
+		config.interactive_add('log', 'segment_size',
+		                       "Split daily logs into segments of this many bytes", '')
 
 def add_filter(bot, method):
 	def filtered_write(self, *args, **kwargs):
@@ -41,16 +60,128 @@ def add_filter(bot, method):
 		return method(*args, **kwargs)
 	return MethodType(filtered_write, bot, type(bot))
 
+def update_symlinks(basepath, filename, date):
+	try:
+		today = basepath + "today.log"
+		target = os.path.relpath(filename, basepath)
+		if not os.path.islink(today) or os.readlink(today) != target:
+			if os.path.islink(today):
+				if date in os.readlink(today):
+					# Next segment of the same day
+					os.remove(today)
+				else:
+					yesterday = basepath + "yesterday.log"
+					if os.path.islink(yesterday):
+						os.remove(yesterday)
+					os.rename(today, yesterday)
+			os.symlink(target, today)
+	except Exception as e:
+		logger.warning(u'Cant update symlinks for {0}: {1}'.format(filename, str(e)))
+
 class Logfile:
+	
 	def __init__(self, date, handle):
 		self.date = date
 		self.handle = handle
+	
+	def write(self, msg, timestamp):
+		self.handle.write(msg)
+		self.handle.flush()
+	
+	def close(self):
+		if self.handle:
+			self.handle.close()
+
+class Segments(Logfile):
+	"""One day of a channel log, split into preallocated segments"""
+	
+	def __init__(self, date, basepath, prefix, size, timestamp):
+		Logfile.__init__(self, date, None)
+		self.basepath = basepath
+		self.prefix = prefix
+		self.size = size
+		self.index = 0
+		self.written = 0
+		self.manifest = prefix + '.manifest'
+		
+		# Continue with the last segment after a restart
+		if os.path.exists(self.manifest):
+			with open(self.manifest, 'r') as manifest:
+				lines = manifest.read().splitlines()
+			if lines:
+				try:
+					self.index = int(lines[-1].split(' ', 1)[0].rsplit('.', 2)[-2])
+				except (ValueError, IndexError):
+					logger.warning(u'Cant parse log manifest {0}, starting a new segment'.format(
+						self.manifest))
+					self.index = self.last_file()
+					self.next(timestamp)
+					return
+				self.open()
+				return
+		
+		self.next(timestamp)
+	
+	def last_file(self):
+		"""Highest segment number on disk"""
+		(directory, name) = os.path.split(self.prefix)
+		index = 0
+		for filename in os.listdir(directory):
+			number = filename[len(name) + 1:-len('.log')]
+			if filename.startswith(name + '.') and filename.endswith('.log') and number.isdigit():
+				index = max(index, int(number))
+		return index
+	
+	def filename(self):
+		return '{0}.{1:03d}.log'.format(self.prefix, self.index)
+	
+	def open(self):
+		filename = self.filename()
+		logger.debug(u'Opening log segment {0}'.format(filename))
+		self.handle = open(filename, 'ab')
+		self.written = os.fstat(self.handle.fileno()).st_size
+		if fallocate and self.written < self.size:
+			# Reserve the space now instead of extending the file with every line
+			if fallocate(self.handle.fileno(), FALLOC_FL_KEEP_SIZE, 0, self.size) != 0:
+				logger.debug(u'Cant preallocate {0}: {1}'.format(
+					filename, os.strerror(ctypes.get_errno())))
+		update_symlinks(self.basepath, filename, self.date)
+	
+	def next(self, timestamp):
+		self.close()
+		self.index += 1
+		with open(self.manifest, 'a') as manifest:
+			manifest.write('{0} {1}\n'.format(os.path.basename(self.filename()),
+			               time.strftime('%Y-%m-%d %H:%M:%S', timestamp)))
+		self.open()
+	
+	def write(self, msg, timestamp):
+		data = msg.encode('utf-8')
+		if self.written and self.written + len(data) > self.size:
+			try:
+				self.next(timestamp)
+			except Exception as e:
+				# Like a log file that can't be opened: stop logging the channel for today
+				logger.warning(u'Cant open next log segment {0}: {1}'.format(self.filename(), str(e)))
+				self.close()
+				return
+		self.handle.write(data)
+		self.handle.flush()
+		self.written += len(data)
+	
+	def close(self):
+		if self.handle:
+			# Give back the preallocated space that was not used
+			os.ftruncate(self.handle.fileno(), self.written)
+			self.handle.close()
+			self.handle = None
 
 class Logger:
 	
-	def __init__(self, exclude, enable):
+	def __init__(self, exclude, enable, segment_size = None):
 		self.exclude = exclude
 		self.enable = enable
+		self.segment_size = segment_size
 		self.files = { }
 		self.lock = threading.Lock()
 	
@@ -61,9 +192,9 @@ class Logger:
 		if channel in self.files:
 			logfile = self.files[channel]
 			if logfile.date == date:
-				return logfile.handle
+				return logfile if logfile.handle else None
 			else:
-				logfile.handle.close()
+				logfile.close()
 		
 		basepath = bot.config.log.path + '/' + channel[1:] + '/'
 		path = basepath + time.strftime('%Y', timestamp)
@@ -76,29 +207,28 @@ class Logger:
 				self.exclude.append(channel)
 				return
 		
+		if self.segment_size:
+			prefix = path + '/' + channel + '.' + date
+			try:
+				logfile = Segments(date, basepath, prefix, self.segment_size, timestamp)
+			except Exception as e:
+				logger.warning(u'Cant open log segment for {0}: {1}'.format(prefix, str(e)))
+				logfile = Logfile(date, None)
+			self.files[channel] = logfile
+			return logfile if logfile.handle else None
+		
 		filename = path + '/' + channel + '.' + date + '.log'
-		logfile = None
+		handle = None
 		try:
 			logger.debug(u'Opening log file {0}'.format(filename))
-			logfile = codecs.open(filename, 'a', encoding='utf-8')
+			handle = codecs.open(filename, 'a', encoding='utf-8')
 		except Exception as e:
 			logger.warning(u'Cant open log file {0}'.format(filename))
 		
-		try:
-			today = basepath + "today.log"
-			target = os.path.relpath(filename, basepath)
-			if not os.path.islink(today) or os.readlink(today) != target:
-				if os.path.islink(today):
-					yesterday = basepath + "yesterday.log"
-					if os.path.islink(yesterday):
-						os.remove(yesterday)
-					os.rename(today, yesterday)
-				os.symlink(target, today)
-		except Exception as e:
-			logger.warning(u'Cant update symlinks for {0}: {1}'.format(filename, str(e)))
+		update_symlinks(basepath, filename, date)
 		
-		self.files[channel] = Logfile(date, logfile)
-		return logfile
+		self.files[channel] = Logfile(date, handle)
+		return self.files[channel] if handle else None
 	
 	# Write a message to the text log file
 	def log(self, bot, channel, msg, *args):
@@ -133,15 +263,14 @@ class Logger:
 			msg = unicode(msg).format(*args)
 			msg = time.strftime('[%Y-%m-%d] %H:%M:%S  ', timestamp) + msg
 			msg = msg + '\n'
-			logfile.write(msg)
-			logfile.flush()
+			logfile.write(msg, timestamp)
 			
 		finally:
 			self.lock.release()
 	
 	def close(self):
 		for channel in self.files:
-			self.files[channel].handle.close()
+			self.files[channel].close()
 		self.files = { }
 
 def setup(bot):
@@ -167,7 +296,11 @@ def setup(bot):
 	write = getattr(bot, 'write');
 	setattr(bot, 'write', add_filter(bot, write))
 	
-	bot.memory['logger'] = Logger(exclude, enable)
+	segment_size = None
+	if bot.config.log.segment_size:
+		segment_size = int(bot.config.log.segment_size)
+	
+	bot.memory['logger'] = Logger(exclude, enable, segment_size)
 	bot.memory['logger_restore_write'] = write
 
 def shutdown(bot):
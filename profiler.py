@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+profiler.py - Willie Module that profiles the other modules at runtime
+Licensed under the Eiffel Forum License 2.
+
+Profiling is off until an admin sends one of:
+ .profile start
+ .profile status
+ .profile stop
+
+While running, a thread samples the stacks of all threads and the functions listed
+in the spans option are timed. Stopping writes two files to the configured dir:
+ stacks-<time>.folded  collapsed stacks, one line per stack (for flamegraph.pl)
+ spans-<time>.txt      count, mean, p50, p95 and max milliseconds per span
+
+Spans are module.Class.method or module.function for modules loaded by Willie,
+or bot.method for the bot itself.
+"""
+
+import os
+import sys
+import time
+import threading
+import logging
+from collections import deque
+from willie.module import commands, priority
+from willie.config import ConfigurationError
+
+
+logger = logging.getLogger('profiler')
+logger.setLevel(logging.INFO)
+
+INTERVAL = 0.01 # seconds between stack samples
+SPAN_SAMPLES = 10000 # durations to keep per span for the percentiles
+SPANS = [ 'log.Logger.log', 'log.Logger.get_logfile', 'pipe.Pipe.process_line',
+          'staticrss.Feed.update', 'staticrss.Feed.download', 'staticrss.Parser.parse',
+          'bot.msg', 'bot.write' ]
+
+
+class Span:
+	"""Durations of calls to one function"""
+	
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.durations = deque(maxlen=SPAN_SAMPLES)
+	
+	
+	def add(self, duration):
+		self.count += 1
+		self.total += duration
+		self.max = max(self.max, duration)
+		self.durations.append(duration)
+	
+	
+	def percentile(self, fraction):
+		durations = sorted(self.durations)
+		return durations[min(len(durations) - 1, int(len(durations) * fraction))]
+	
+	
+	def report(self, name):
+		return u'{0} count={1} mean={2:.3f} p50={3:.3f} p95={4:.3f} max={5:.3f}'.format(
+			name, self.count, 1000 * self.total / self.count, 1000 * self.percentile(0.5),
+			1000 * self.percentile(0.95), 1000 * self.max)
+
+
+class Profiler:
+	
+	def __init__(self, bot, path, interval, spans):
+		self.bot = bot
+		self.path = path
+		self.interval = interval
+		self.spans = spans
+		self.stacks = { }
+		self.samples = 0
+		self.timings = { }
+		self.patched = [ ]
+		self.started = None
+		self.thread = None
+		self.running = False
+		self.lock = threading.Lock()
+	
+	
+	def timed(self, name, function):
+		def timed(*args, **kwargs):
+			start = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				duration = time.time() - start
+				with self.lock:
+					if name not in self.timings:
+						self.timings[name] = Span()
+					self.timings[name].add(duration)
+		timed.__name__ = function.__name__
+		timed.__doc__ = function.__doc__
+		return timed
+	
+	
+	def find(self, span):
+		"""Return the object owning the function for a span and the attribute name"""
+		
+		(path, _, attribute) = span.rpartition('.')
+		names = path.split('.')
+		if names[0] == 'bot':
+			owner = self.bot
+		elif names[0] in sys.modules:
+			owner = sys.modules[names[0]]
+		else:
+			return (None, attribute)
+		
+		for name in names[1:]:
+			owner = getattr(owner, name, None)
+		
+		return (owner, attribute)
+	
+	
+	def patch(self):
+		
+		for span in self.spans:
+			
+			(owner, attribute) = self.find(span)
+			
+			# Use the raw function for classes so that it still binds to instances
+			if owner is None:
+				function = None
+			elif isinstance(owner, (type, type(Profiler))):
+				function = owner.__dict__.get(attribute)
+			else:
+				function = getattr(owner, attribute, None)
+			if not callable(function):
+				logger.info(u'Not timing {0}: not loaded'.format(span))
+				continue
+			
+			own = attribute in getattr(owner, '__dict__', { })
+			setattr(owner, attribute, self.timed(span, function))
+			self.patched.append((owner, attribute, function, own))
+	
+	
+	def unpatch(self):
+		for (owner, attribute, function, own) in reversed(self.patched):
+			if own:
+				setattr(owner, attribute, function)
+			else:
+				delattr(owner, attribute)
+		self.patched = [ ]
+	
+	
+	def sample(self):
+		
+		names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+		own = threading.current_thread().ident
+		
+		for (ident, frame) in sys._current_frames().items():
+			
+			if ident == own:
+				continue
+			
+			stack = [ ]
+			while frame is not None:
+				code = frame.f_code
+				stack.append(u'{0} ({1}:{2})'.format(code.co_name,
+					os.path.basename(code.co_filename), code.co_firstlineno))
+				frame = frame.f_back
+			stack.append(names.get(ident, u'thread-{0}'.format(ident)).replace(u';', u':'))
+			
+			stack = u';'.join(reversed(stack))
+			self.stacks[stack] = self.stacks.get(stack, 0) + 1
+		
+		self.samples += 1
+	
+	
+	def run(self):
+		while self.running:
+			try:
+				self.sample()
+			except Exception as e:
+				logger.warning(u'Sampling failed: {0}'.format(e))
+			time.sleep(self.interval)
+	
+	
+	def start(self):
+		if self.thread is not None:
+			return
+		self.stacks = { }
+		self.samples = 0
+		self.timings = { }
+		self.started = time.time()
+		self.patch()
+		self.running = True
+		self.thread = threading.Thread(target=self.run, name='profiler')
+		self.thread.daemon = True
+		self.thread.start()
+	
+	
+	def stop(self):
+		if self.thread is None:
+			return None
+		self.running = False
+		self.thread.join()
+		self.thread = None
+		self.unpatch()
+		return self.write()
+	
+	
+	def write(self):
+		
+		suffix = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+		
+		# The sampler has stopped, but timed functions may still be running
+		with self.lock:
+			
+			stacks = os.path.join(self.path, 'stacks-{0}.folded'.format(suffix))
+			handle = open(stacks, 'w')
+			try:
+				for (stack, count) in sorted(self.stacks.items()):
+					handle.write(u'{0} {1}\n'.format(stack, count).encode('utf-8'))
+			finally:
+				handle.close()
+			
+			spans = os.path.join(self.path, 'spans-{0}.txt'.format(suffix))
+			handle = open(spans, 'w')
+			try:
+				for (name, span) in sorted(self.timings.items()):
+					handle.write(span.report(name).encode('utf-8') + '\n')
+			finally:
+				handle.close()
+		
+		return (stacks, spans)
+	
+	
+	def status(self):
+		if self.thread is None:
+			return u'Profiler is stopped'
+		with self.lock:
+			calls = sum(span.count for span in self.timings.values())
+			return u'Profiling for {0:.0f}s: {1} samples, {2} stacks, {3} timed calls'.format(
+				time.time() - self.started, self.samples, len(self.stacks), calls)
+
+
+def setup(bot):
+	
+	if not bot.config.has_section('profiler'):
+		raise ConfigurationError(u'Missing profiler config section')
+	
+	path = bot.config.profiler.dir
+	if not path:
+		raise ConfigurationError(u'Missing dir in profiler config section')
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	
+	interval = INTERVAL
+	if bot.config.profiler.interval:
+		interval = float(bot.config.profiler.interval)
+	
+	spans = bot.config.profiler.get_list('spans')
+	if not spans:
+		spans = SPANS
+	
+	bot.memory['profiler'] = Profiler(bot, path, interval, spans)
+
+
+@commands('profile')
+@priority('low')
+def profile(bot, trigger):
+	"""Start or stop the profiler or show its status: .profile start|stop|status"""
+	
+	if not trigger.admin:
+		return
+	
+	profiler = bot.memory['profiler']
+	action = (trigger.group(2) or u'status').strip()
+	
+	if action == u'start':
+		profiler.start()
+		bot.say(profiler.status())
+	elif action == u'stop':
+		files = profiler.stop()
+		if files:
+			bot.say(u'Profile written to {0} and {1}'.format(*files))
+		else:
+			bot.say(u'Profiler is not running')
+	elif action == u'status':
+		bot.say(profiler.status())
+	else:
+		bot.say(u'Usage: .profile start|stop|status')
+
+
+def shutdown(bot):
+	
+	profiler = bot.memory['profiler']
+	
+	try:
+		profiler.stop()
+	except Exception as e:
+		logger.warning(u'Can\'t write profile: {0}'.format(e))
+	
+	bot.memory['profiler'] = None
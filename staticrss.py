@@ -6,51 +6,914 @@ Copyright 2012, Michael Yanovich, yanovich.net (original RSS module)
 Licensed under the Eiffel Forum License 2.
 
 This is a modification of the standard Willie RSS module with the folloing changes:
-- Is configured via config file, exposes no commands
-- Does not require database for feed state (ignores all messages before startup)
+- Is configured via config file, the only command is the admin-only rssstats
+- Keeps feed state in a single SQLite file instead of Willie's database
+  (ignores all messages before startup)
 - Supports multiple messages between polls
 - Allows customizing feed titles and URLs
 - Backoff instead of completely disabling broken feeds
+- Reuses keep-alive HTTP connections to the same host between polls
+  (honours http_proxy, https_proxy and no_proxy from the environment)
+- Remembers ETag and Last-Modified validators across restarts
+- Skips parsing documents whose content hash did not change
+- Scrapes pages with precompiled soup expressions or CSS selectors
+- Optionally stops parsing large feeds after a run of already known items
+- Remembers a bounded history of item digests instead of only the last snapshot
+- Optionally adapts the poll interval to how often a feed changes
+- Queues announcements per channel and merges bursts into fewer lines
+- Re-reads local feed files as soon as they are written (inotify, Linux only)
+- Pauses all feeds on a host that keeps failing instead of timing out on each
+- Collects fetch and parse statistics (rssstats and an optional stats file)
+- Loads feed state in the background and imports parsers on first use
+- Optionally parses documents in worker processes, with size and time limits
 """
 
 from datetime import datetime
 import time
 import re
 import os
+import random
 import socket
+import ssl
 import threading
-import feedparser
-import urllib2
+import select
+import struct
+import ctypes
+import ctypes.util
+import importlib
+import multiprocessing
+import httplib
+import urllib
 import urlparse
+import base64
+import zlib
+import hashlib
+import email.utils
 import traceback
 import codecs
+import sqlite3
 import logging
+from cStringIO import StringIO
+from xml.etree import cElementTree
 from copy import copy
-from willie.module import interval
+from collections import OrderedDict, deque
+from willie.module import interval, commands, priority
 from willie.config import ConfigurationError
-from bs4 import BeautifulSoup
-from collections import namedtuple
+
+
+class LazyModule:
+	"""Module that is only imported on first use, to keep startup fast"""
+	
+	def __init__(self, name):
+		self.name = name
+		self.module = None
+		self.available = None
+	
+	def load(self):
+		if self.module is None:
+			self.module = importlib.import_module(self.name)
+		return self.module
+	
+	def __getattr__(self, name):
+		return getattr(self.load(), name)
+	
+	def __nonzero__(self):
+		"""False if the module is not installed"""
+		if self.available is None:
+			try:
+				self.load()
+				self.available = True
+			except ImportError:
+				self.available = False
+		return self.available
+
+feedparser = LazyModule('feedparser')
+bs4 = LazyModule('bs4')
+soupsieve = LazyModule('soupsieve') # optional
 
 
 socket.setdefaulttimeout(10)
 
 INTERVAL = 30 # seconds between checking for new updates
 MAX_LINE_LENGTH = 390
+SEND_DELAY = 2 # seconds between announcements to the same channel
+SEPARATOR = u' | ' # between merged announcements
+DEBOUNCE = 1 # seconds to wait for more writes to a local feed file
+STATS_INTERVAL = 5 * 60 # seconds between writes of the stats file
+STATS_TOP = 5 # feeds shown by the rssstats command
+MAX_CONNECTIONS = 4 # open connections per host
+IDLE_TIMEOUT = 60 # seconds before an unused connection is closed
+MAX_REDIRECTS = 5
+HOST_FAILURES = 3 # consecutive failures before pausing all feeds on a host
+HOST_BACKOFF = 60 # seconds to pause a failing host for the first time
+MAX_HOST_BACKOFF = 60 * 60
+HISTORY = 500 # known items to remember per feed
+ARRIVALS = 8 # new item times to remember per feed for adaptive polling
+UPDATE_PERIODS = { 'hourly' : 60 * 60, 'daily' : 24 * 60 * 60, 'weekly' : 7 * 24 * 60 * 60,
+                   'monthly' : 30 * 24 * 60 * 60, 'yearly' : 365 * 24 * 60 * 60 }
+CHUNK_SIZE = 64 * 1024
+MAX_SIZE = 8 * 1024 * 1024 # largest document to parse
+PARSE_TIMEOUT = 30 # seconds before a worker process parsing a document is killed
+ATTRIBUTE = re.compile(r'\s*@([\w:-]+)$') # trailing @attribute of a CSS selector
+ENTRY_FIELDS = ('title', 'link', 'published', 'published_parsed', 'guid')
+FEED_FIELDS = ('ttl', 'sy_updateperiod', 'sy_updatefrequency')
+STATE_HEADER = u'# staticrss state'
+STORE = 'staticrss.db' # default state database in the rss state directory
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+ENTRY_TAGS = ('item', '{http://purl.org/rss/1.0/}item', ATOM + 'entry')
 
 logger = logging.getLogger('staticrss')
 logger.setLevel(logging.INFO)
 
-class DefaultErrorHandler(urllib2.HTTPDefaultErrorHandler):
-	def http_error_default(self, req, fp, code, msg, headers):
-		result = urllib2.HTTPError(req.get_full_url(), code, msg, headers, fp)
-		result.status = code
-		return result
+class HTTPError(IOError):
+	def __init__(self, url, code, msg):
+		IOError.__init__(self, u'HTTP Error {0}: {1}'.format(code, msg))
+		self.url = url
+		self.code = code
+
+
+class TooLarge(Exception):
+	"""Document is larger than the feed's max_size, not a problem with the host"""
+	def __init__(self, limit):
+		Exception.__init__(self, u'Document too large: more than {0} bytes'.format(limit))
+
+
+class Response:
+	"""A completely read HTTP response"""
+	
+	def __init__(self, href, status, reason, headers, body, digest, moved = False):
+		self.href = href
+		self.status = status
+		self.reason = reason
+		self.headers = headers
+		self.body = body
+		self.digest = digest # hash of the decoded body
+		self.moved = moved # all redirects were permanent
+		self.etag = headers.get('etag')
+		self.modified = headers.get('last-modified')
+		self.size = len(body) # bytes received
+		self.dns = 0 # seconds spent resolving host names
+		self.connect = 0 # seconds spent connecting, including TLS handshakes
+		self.transfer = 0 # seconds spent sending requests and receiving responses
+
+
+def read_body(stream, encoding = None, limit = None):
+	"""Read and decode a document in chunks while hashing it
+	
+	Raises TooLarge as soon as more than limit decoded bytes have been read.
+	"""
+	
+	decoder = None
+	if encoding == 'gzip' or encoding == 'deflate':
+		decoder = zlib.decompressobj(32 + zlib.MAX_WBITS) # zlib or gzip header
+	
+	chunks = [ ]
+	digest = hashlib.sha1()
+	size = 0
+	decoded = 0
+	while True:
+		chunk = stream.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		size += len(chunk)
+		if decoder:
+			if not chunks and encoding == 'deflate' and (len(chunk) < 2
+			   or (ord(chunk[0]) & 0x0f) != 8 or (ord(chunk[0]) * 256 + ord(chunk[1])) % 31):
+				decoder = zlib.decompressobj(-zlib.MAX_WBITS) # raw deflate stream
+			# Never inflate more than one byte past the limit
+			chunk = decoder.decompress(chunk, limit - decoded + 1 if limit else 0)
+		decoded += len(chunk)
+		if limit and decoded > limit:
+			raise TooLarge(limit)
+		digest.update(chunk)
+		chunks.append(chunk)
+	
+	if decoder:
+		chunk = decoder.flush()
+		decoded += len(chunk)
+		if limit and decoded > limit:
+			raise TooLarge(limit)
+		digest.update(chunk)
+		chunks.append(chunk)
+	
+	return (''.join(chunks), digest.hexdigest(), size)
+
+
+def iter_entries(body, base):
+	"""Parse RSS and Atom entries in document order without building the whole tree
+	
+	This only understands the subset of the formats needed for guids and
+	announcements and raises SyntaxError for anything that is not well-formed XML
+	or has no entries it knows, so that the caller can fall back to feedparser.
+	Guids and links are resolved like feedparser does, including xml:base, as
+	both parsers are used for the same feed.
+	"""
+	
+	bases = [ base ] # xml:base of the open elements
+	seen = False
+	
+	for (event, element) in cElementTree.iterparse(StringIO(body), events=('start', 'end')):
+		
+		if event == 'start':
+			bases.append(urlparse.urljoin(bases[-1], element.get(XML_BASE, '')))
+			seen = seen or element.tag in ENTRY_TAGS
+			continue
+		
+		bases.pop()
+		
+		if element.tag not in ENTRY_TAGS:
+			continue
+		
+		entry = Record()
+		here = urlparse.urljoin(bases[-1], element.get(XML_BASE, ''))
+		guid_is_link = False
+		
+		for child in element:
+			tag = child.tag.rpartition('}')[2]
+			text = (child.text or '').strip()
+			child_base = urlparse.urljoin(here, child.get(XML_BASE, ''))
+			if tag == 'title':
+				entry['title'] = u''.join(child.itertext()).strip()
+			elif tag == 'link':
+				if child.tag == ATOM + 'link':
+					if child.get('rel', 'alternate') == 'alternate' and 'link' not in entry:
+						entry['link'] = urlparse.urljoin(child_base, child.get('href', ''))
+				else:
+					entry['link'] = urlparse.urljoin(child_base, text)
+			elif tag == 'guid':
+				guid_is_link = (child.get('isPermaLink', 'true') != 'false')
+				if guid_is_link:
+					text = urlparse.urljoin(child_base, text)
+				entry['guid'] = text
+			elif tag == 'id' and child.tag == ATOM + 'id':
+				guid_is_link = True
+				entry['guid'] = urlparse.urljoin(child_base, text)
+			elif tag == 'pubDate' or (tag == 'published' and child.tag == ATOM + 'published'):
+				entry['published'] = text
+				parsed = feedparser._parse_date(text)
+				if parsed:
+					entry['published_parsed'] = parsed
+		
+		# feedparser uses the guid as the link if there is none
+		if guid_is_link and 'guid' in entry and 'link' not in entry:
+			entry['link'] = entry['guid']
+		
+		element.clear()
+		
+		yield entry
+	
+	if not seen:
+		raise SyntaxError(u'No RSS 2.0, RSS 1.0 or Atom 1.0 entries')
+
+
+class History:
+	"""Bounded set of item digests, ordered from oldest to newest"""
+	
+	def __init__(self):
+		self.items = OrderedDict()
+	
+	
+	@staticmethod
+	def key(guid):
+		return hashlib.md5(guid.encode('utf-8')).digest()
+	
+	
+	def __contains__(self, key):
+		return key in self.items
+	
+	
+	def __len__(self):
+		return len(self.items)
+	
+	
+	def __iter__(self):
+		return iter(self.items)
+	
+	
+	def add(self, key):
+		if key in self.items:
+			del self.items[key]
+		self.items[key] = None
+	
+	
+	def trim(self, size):
+		removed = [ ]
+		while len(self.items) > size:
+			removed.append(self.items.popitem(last=False)[0])
+		return removed
+
+
+class Store:
+	"""SQLite database holding the state of all feeds"""
+	
+	def __init__(self, path):
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.lock = threading.Lock()
+		with self.lock:
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			with self.db:
+				self.db.execute('CREATE TABLE IF NOT EXISTS feeds (name TEXT PRIMARY KEY, '
+				                'time REAL, etag TEXT, modified, digest TEXT, window INTEGER)')
+				self.db.execute('CREATE TABLE IF NOT EXISTS items (feed TEXT, key BLOB, '
+				                'seq INTEGER, PRIMARY KEY (feed, key))')
+				self.db.execute('CREATE INDEX IF NOT EXISTS items_seq ON items (feed, seq)')
+	
+	
+	def load(self):
+		"""Load the state of all feeds, returns { name : (row, [ keys ]) }"""
+		states = { }
+		with self.lock:
+			for row in self.db.execute('SELECT name, time, etag, modified, digest, window '
+			                           'FROM feeds'):
+				states[row[0]] = (row, [ ])
+			for (feed, key) in self.db.execute('SELECT feed, key FROM items ORDER BY feed, seq'):
+				if feed in states:
+					states[feed][1].append(str(key))
+		return states
+	
+	
+	def save(self, feed, keys, removed):
+		"""Update the state of one feed and add or refresh the given item keys"""
+		with self.lock:
+			with self.db:
+				self.db.execute('INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?, ?, ?)',
+				                (feed.name, feed.old_time, feed.etag, feed.modified,
+				                 feed.digest, feed.window))
+				(seq, ) = self.db.execute('SELECT COALESCE(MAX(seq), 0) FROM items WHERE feed = ?',
+				                          (feed.name, )).fetchone()
+				self.db.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+				                    [ (feed.name, buffer(key), seq + i + 1)
+				                      for (i, key) in enumerate(keys) ])
+				self.db.executemany('DELETE FROM items WHERE feed = ? AND key = ?',
+				                    [ (feed.name, buffer(key)) for key in removed ])
+	
+	
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+
+class Extractor:
+	"""Soup expression or CSS selector, compiled once per feed
+	
+	CSS selectors can end with @attribute to extract an attribute value instead of
+	the element text.
+	"""
+	
+	def __init__(self, variable, expression = None, selector = None):
+		self.spec = (variable, expression, selector)
+		self.variable = variable
+		self.code = None
+		self.selector = None
+		self.attribute = None
+		if selector:
+			match = ATTRIBUTE.search(selector)
+			if match:
+				selector = selector[:match.start()]
+				self.attribute = match.group(1)
+			self.selector = soupsieve.compile(selector) if soupsieve else selector
+		else:
+			self.code = compile(expression, '<soup>', 'eval')
+	
+	
+	def all(self, tag):
+		if self.code:
+			return eval(self.code, {}, {self.variable : tag})
+		if soupsieve:
+			return self.selector.select(tag)
+		return tag.select(self.selector)
+	
+	
+	def one(self, tag):
+		if self.code:
+			return eval(self.code, {}, {self.variable : tag})
+		if soupsieve:
+			result = self.selector.select_one(tag)
+		else:
+			result = tag.select_one(self.selector)
+		if result is not None and self.attribute:
+			result = result.get(self.attribute)
+			if isinstance(result, list):
+				result = u' '.join(result) # class, rel and other multi-valued attributes
+		return result if result is not None else u''
+
+
+class Record(dict):
+	"""Parsed document or entry with attribute access, like feedparser's results"""
+	
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name)
+
+
+extractors = { } # per process cache of compiled extractors
+
+
+def get_extractor(spec):
+	if spec is None:
+		return None
+	if spec not in extractors:
+		extractors[spec] = Extractor(*spec)
+	return extractors[spec]
+
+
+def get_text(blob):
+	try:
+		return blob.get_text().strip()
+	except:
+		return blob.strip()
+
+
+def parse_feed(body, headers):
+	"""Parse a feed and return only the fields needed for guids and announcements
+	
+	This runs in a worker process if parse_processes is set, so it takes and
+	returns only plain data.
+	"""
+	
+	fp = feedparser.parse(body, response_headers=headers)
+	
+	# Check for malformed XML
+	if fp.bozo and not isinstance(fp.bozo_exception, feedparser.CharacterEncodingOverride):
+		raise ValueError(u'Malformed feed: {0}'.format(fp.bozo_exception))
+	
+	entries = [ ]
+	for entry in fp.entries:
+		entries.append(dict((key, entry[key]) for key in ENTRY_FIELDS if key in entry))
+	
+	channel = fp.get('feed', { })
+	channel = dict((key, channel[key]) for key in FEED_FIELDS if key in channel)
+	
+	return { 'entries' : entries, 'feed' : channel }
+
+
+def parse_soup(body, base, parser, specs):
+	"""Scrape entries from a page, see parse_feed"""
+	
+	(posts, titles, links, published) = [ get_extractor(spec) for spec in specs ]
+	
+	if parser:
+		page = bs4.BeautifulSoup(body, parser)
+	else:
+		page = bs4.BeautifulSoup(body)
+	
+	entries = [ ]
+	
+	for post in posts.all(page):
+		
+		entry = { }
+		
+		if titles:
+			entry['title'] = get_text(titles.one(post))
+		
+		if links:
+			entry['link'] = urlparse.urljoin(base, get_text(links.one(post)))
+		
+		if published:
+			entry['published'] = get_text(published.one(post))
+		
+		entries.append(entry)
+	
+	return { 'entries' : entries }
+
+
+class Parser:
+	"""Runs parse_feed and parse_soup, in worker processes if configured
+	
+	Parsing big documents holds the GIL for a long time, which stalls all other
+	threads of the bot. Workers that take longer than the timeout are killed.
+	
+	The workers are forked, so the pool is started in setup before staticrss
+	starts its own threads. Willie's threads and, after a timeout, ours are
+	running when a pool is forked: a lock that one of them holds at that moment
+	(e.g. the logging lock) stays locked in the workers forever, so the parse
+	functions must not log or share locks with the bot.
+	"""
+	
+	def __init__(self, processes, timeout):
+		self.processes = processes
+		self.timeout = timeout
+		self.pool = None
+	
+	
+	def start(self):
+		if self.processes and self.pool is None:
+			self.pool = multiprocessing.Pool(self.processes)
+	
+	
+	def parse(self, function, *args):
+		
+		if not self.processes:
+			result = function(*args)
+		else:
+			self.start()
+			try:
+				result = self.pool.apply_async(function, args).get(self.timeout)
+			except multiprocessing.TimeoutError:
+				# There is no way to cancel a single task
+				self.close()
+				raise RuntimeError(u'Parsing took longer than {0}s'.format(self.timeout))
+		
+		return Record(result, entries=[ Record(entry) for entry in result['entries'] ])
+	
+	
+	def close(self):
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+
+class Stats:
+	"""Fetch and parse statistics for one feed"""
+	
+	def __init__(self):
+		self.polls = 0
+		self.errors = 0
+		self.not_modified = 0 # status 304 or unchanged local file
+		self.unchanged = 0 # same etag or modification time
+		self.fetches = 0
+		self.dns = 0.0
+		self.connect = 0.0
+		self.transfer = 0.0
+		self.bytes = 0
+		self.feed_parses = 0
+		self.feed_time = 0.0
+		self.soup_parses = 0
+		self.soup_time = 0.0
+		self.entries = 0 # in the last parsed document
+		self.new_items = 0
+		self.first_poll = None
+		self.last_poll = None
+	
+	
+	def poll(self):
+		now = time.time()
+		if self.first_poll is None:
+			self.first_poll = now
+		self.last_poll = now
+		self.polls += 1
+	
+	
+	def fetched(self, response):
+		self.fetches += 1
+		self.dns += response.dns
+		self.connect += response.connect
+		self.transfer += response.transfer
+		self.bytes += response.size
+	
+	
+	def parsed(self, soup, seconds, entries):
+		if soup:
+			self.soup_parses += 1
+			self.soup_time += seconds
+		else:
+			self.feed_parses += 1
+			self.feed_time += seconds
+		self.entries = entries
+	
+	
+	def add(self, other):
+		for (key, value) in vars(other).items():
+			if key not in ('entries', 'first_poll', 'last_poll'):
+				setattr(self, key, getattr(self, key) + value)
+		self.entries += other.entries
+	
+	
+	def cost(self):
+		return self.dns + self.connect + self.transfer + self.feed_time + self.soup_time
+	
+	
+	def actual_interval(self):
+		if self.polls < 2 or self.first_poll is None:
+			return 0
+		return (self.last_poll - self.first_poll) / (self.polls - 1)
+	
+	
+	def report(self, name, skipped, backoff, interval, current):
+		
+		def percent(count):
+			return 100.0 * count / self.polls if self.polls else 0.0
+		
+		def average(seconds, count):
+			return 1000.0 * seconds / count if count else 0.0
+		
+		def duration(seconds):
+			return u'-' if seconds is None else u'{0}s'.format(seconds)
+		
+		return (u'{0}: polls={1} errors={2} 304={3:.0f}% same={4:.0f}% skipped={5} '
+		        u'dns={6:.0f}ms connect={7:.0f}ms transfer={8:.0f}ms bytes={9} '
+		        u'feedparser={10:.0f}ms soup={11:.0f}ms entries={12} new={13} '
+		        u'backoff={14} interval={15} current={16} actual={17:.0f}s').format(
+		        name, self.polls, self.errors, percent(self.not_modified),
+		        percent(self.unchanged), skipped,
+		        average(self.dns, self.fetches), average(self.connect, self.fetches),
+		        average(self.transfer, self.fetches), self.bytes,
+		        average(self.feed_time, self.feed_parses), average(self.soup_time, self.soup_parses),
+		        self.entries, self.new_items, duration(backoff), duration(interval),
+		        duration(current), self.actual_interval())
+
+
+class Host:
+	
+	def __init__(self, name):
+		self.name = name
+		self.failures = 0 # consecutive failures
+		self.trips = 0 # consecutive times the circuit was opened
+		self.until = 0 # circuit is open until this time
+		self.probing = False # half-open: one fetch is testing the host
+
+
+class Hosts:
+	"""Circuit breaker per host
+	
+	Concurrent connections per host are limited by HTTPPool.
+	"""
+	
+	def __init__(self, failures, backoff, max_backoff):
+		self.failures = failures
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.hosts = { }
+		self.lock = threading.Lock()
+	
+	
+	def get(self, url):
+		name = urlparse.urlsplit(url).netloc.rpartition('@')[2]
+		with self.lock:
+			if name not in self.hosts:
+				self.hosts[name] = Host(name)
+			return self.hosts[name]
+	
+	
+	def acquire(self, host):
+		with self.lock:
+			if host.trips:
+				if host.probing or time.time() < host.until:
+					return False
+				host.probing = True
+			return True
+	
+	
+	def release(self, host, ok):
+		"""Returns a message if the state of the circuit changed
+		
+		ok is None if the fetch did not get as far as the host.
+		"""
+		with self.lock:
+			host.probing = False
+			if ok is None:
+				return None
+			if ok:
+				host.failures = 0
+				if host.trips:
+					host.trips = 0
+					return u'{0}: Host is back up'.format(host.name)
+				return None
+			host.failures += 1
+			if host.failures < self.failures and not host.trips:
+				return None
+			host.trips += 1
+			delay = min(self.max_backoff, self.backoff * 2 ** (host.trips - 1))
+			delay = random.uniform(delay / 2.0, delay)
+			host.until = time.time() + delay
+			if host.trips == 1:
+				return u'{0}: Host is down, pausing its feeds for {1:.0f} seconds'.format(
+					host.name, delay)
+			return None
+
+
+class TimedConnection:
+	"""Mixin for httplib connections that times name lookup and connecting separately"""
+	
+	dns = 0
+	connect_time = 0
+	
+	def open_socket(self):
+		start = time.time()
+		addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+		resolved = time.time()
+		self.dns = resolved - start
+		error = socket.error('getaddrinfo returned an empty list')
+		for (family, socktype, proto, name, address) in addresses:
+			try:
+				sock = socket.create_connection(address[:2], self.timeout, self.source_address)
+				self.connect_time = time.time() - resolved
+				return sock
+			except socket.error as e:
+				error = e
+		raise error
+
+
+def proxy_authorization(proxy):
+	"""Basic auth header for the credentials in a proxy URL, if any"""
+	if proxy.username is None:
+		return { }
+	credentials = u'{0}:{1}'.format(urllib.unquote(proxy.username),
+	                                urllib.unquote(proxy.password or ''))
+	return { 'Proxy-Authorization' : 'Basic ' + base64.b64encode(credentials) }
+
+
+class HTTPConnection(TimedConnection, httplib.HTTPConnection):
+	
+	def connect(self):
+		self.sock = self.open_socket()
+
+
+class HTTPSConnection(TimedConnection, httplib.HTTPSConnection):
+	
+	def connect(self):
+		sock = self.open_socket()
+		start = time.time()
+		host = self.host
+		if self._tunnel_host:
+			# CONNECT through a proxy before starting TLS
+			self.sock = sock
+			self._tunnel()
+			host = self._tunnel_host
+		context = getattr(self, '_context', None)
+		if context is not None:
+			self.sock = context.wrap_socket(sock, server_hostname=host)
+		else:
+			self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+		self.connect_time += time.time() - start
+
+
+class HTTPPool:
+	"""Keep-alive HTTP connections shared by all feeds, grouped per host"""
+	
+	def __init__(self, max_connections, idle_timeout):
+		self.max_connections = max_connections
+		self.idle_timeout = idle_timeout
+		self.idle = { } # (scheme, netloc, proxy) -> [ (connection, last used) ]
+		self.busy = { } # (scheme, netloc, proxy) -> number of connections in use
+		self.proxies = urllib.getproxies()
+		self.lock = threading.Condition()
+	
+	
+	def proxy(self, scheme, host):
+		"""Proxy URL to use for a host, like urllib2 does"""
+		if urllib.proxy_bypass(host):
+			return None
+		return self.proxies.get(scheme)
+	
+	
+	@staticmethod
+	def connect(key):
+		(scheme, host, proxy) = key
+		if proxy:
+			proxy = urlparse.urlsplit(proxy)
+			if scheme == 'https':
+				connection = HTTPSConnection(proxy.hostname, proxy.port or 80)
+				connection.set_tunnel(host, headers=proxy_authorization(proxy))
+				return connection
+			return HTTPConnection(proxy.hostname, proxy.port or 80)
+		if scheme == 'https':
+			return HTTPSConnection(host)
+		return HTTPConnection(host)
+	
+	
+	def evict(self):
+		now = time.time()
+		for key in self.idle.keys():
+			keep = [ ]
+			for (connection, used) in self.idle[key]:
+				if now - used < self.idle_timeout:
+					keep.append((connection, used))
+				else:
+					connection.close()
+			if keep:
+				self.idle[key] = keep
+			else:
+				del self.idle[key]
+	
+	
+	def acquire(self, key):
+		with self.lock:
+			self.evict()
+			while True:
+				if self.idle.get(key):
+					(connection, used) = self.idle[key].pop()
+					self.busy[key] = self.busy.get(key, 0) + 1
+					return (connection, True)
+				if self.busy.get(key, 0) < self.max_connections:
+					self.busy[key] = self.busy.get(key, 0) + 1
+					break
+				self.lock.wait()
+		return (self.connect(key), False)
+	
+	
+	def release(self, key, connection, reuse):
+		with self.lock:
+			self.busy[key] -= 1
+			if reuse:
+				self.idle.setdefault(key, [ ]).append((connection, time.time()))
+			else:
+				connection.close()
+			self.lock.notify()
+	
+	
+	def close(self):
+		with self.lock:
+			for key in self.idle:
+				for (connection, used) in self.idle[key]:
+					connection.close()
+			self.idle = { }
+	
+	
+	def request(self, key, path, headers, limit):
+		(connection, reused) = self.acquire(key)
+		reuse = False
+		start = time.time()
+		try:
+			try:
+				connection.request('GET', path, headers=headers)
+				response = connection.getresponse()
+			except (httplib.HTTPException, socket.error):
+				if not reused:
+					raise
+				# The server closed the idle connection, retry once with a new one
+				connection.close()
+				connection = self.connect(key)
+				connection.request('GET', path, headers=headers)
+				response = connection.getresponse()
+			(body, digest, size) = read_body(response, response.getheader('content-encoding'),
+			                                 limit)
+			reuse = not response.will_close
+			timing = (connection.dns, connection.connect_time,
+			          time.time() - start - connection.dns - connection.connect_time, size)
+			connection.dns = connection.connect_time = 0
+		finally:
+			self.release(key, connection, reuse)
+		return (response, body, digest, timing)
+	
+	
+	def get(self, url, headers, limit = None):
+		
+		moved = True
+		timings = [ ]
+		for i in range(MAX_REDIRECTS + 1):
+			
+			parts = urlparse.urlsplit(url)
+			if parts.scheme not in ('http', 'https'):
+				raise IOError(u'Unsupported URL scheme: {0}'.format(url))
+			
+			request_headers = dict(headers)
+			request_headers['Accept-Encoding'] = 'gzip, deflate'
+			if parts.username is not None:
+				credentials = u'{0}:{1}'.format(parts.username, parts.password or '')
+				request_headers['Authorization'] = 'Basic ' + base64.b64encode(credentials)
+			
+			netloc = parts.netloc.rpartition('@')[2]
+			path = parts.path or '/'
+			if parts.query:
+				path += '?' + parts.query
+			
+			proxy = self.proxy(parts.scheme, netloc)
+			if proxy and parts.scheme == 'http':
+				# Plain HTTP proxies get the absolute URL instead of a tunnel
+				path = urlparse.urlunsplit((parts.scheme, netloc, path, '', ''))
+				request_headers.update(proxy_authorization(urlparse.urlsplit(proxy)))
+			key = (parts.scheme, netloc, proxy)
+			
+			(response, body, digest, timing) = self.request(key, path, request_headers, limit)
+			timings.append(timing)
+			
+			location = response.getheader('location')
+			if response.status in (301, 302, 303, 307, 308) and location:
+				moved = moved and response.status in (301, 308)
+				url = urlparse.urljoin(url, location)
+				continue
+			
+			headers = dict(response.getheaders())
+			result = Response(url, response.status, response.reason, headers, body, digest,
+			                  moved and i > 0)
+			(result.dns, result.connect, result.transfer, result.size) = map(sum, zip(*timings))
+			return result
+		
+		raise IOError(u'Too many redirects: {0}'.format(url))
+
 
 class Feed:
 	
 	
 	def __init__(self):
 		self.max_items = 5
+		self.incremental = 0
+		self.history = HISTORY
+		self.window = 0 # entries in the last completely parsed document
+		self.adaptive = False
+		self.min_interval = None
+		self.max_interval = None
+		self.next_interval = None
+		self.arrivals = None
+		self.expires = 0 # seconds the server asked us to wait
+		self.ttl = 0 # seconds the feed asked us to wait
 		self.name = '(default)'
 		self.url = None
 		self.interval = 0
@@ -63,6 +926,16 @@ class Feed:
 		self.link_pattern = re.compile(r'(.*)')
 		self.link_format = None
 		self.published_soup = None
+		self.soup_select = None
+		self.title_select = None
+		self.link_select = None
+		self.published_select = None
+		self.soup_parser = None
+		self.max_size = MAX_SIZE
+		self.posts = None
+		self.titles = None
+		self.links = None
+		self.published = None
 		self.exclude = set()
 		self.enable = set()
 		self.old_items = None
@@ -70,7 +943,14 @@ class Feed:
 		self.backoff = 0
 		self.etag = None
 		self.modified = None
+		self.digest = None
+		self.skipped_parses = 0
 		self.state = None
+		self.store = None
+		self.host = None
+		self.acquired = False
+		self.stats = None
+		self.loaded = False
 	
 	
 	def parse_config(self, section):
@@ -82,6 +962,15 @@ class Feed:
 			self.interval = int(section.interval) * 60
 			self.age = self.interval + 1
 		
+		if section.adaptive is not None:
+			self.adaptive = bool(section.adaptive)
+		
+		if section.min_interval:
+			self.min_interval = int(section.min_interval) * 60
+		
+		if section.max_interval:
+			self.max_interval = int(section.max_interval) * 60
+		
 		if section.soup:
 			self.soup = section.soup
 		
@@ -106,6 +995,24 @@ class Feed:
 		if section.published_soup:
 			self.published_soup = section.published_soup
 		
+		if section.soup_select:
+			self.soup_select = section.soup_select
+		
+		if section.title_select:
+			self.title_select = section.title_select
+		
+		if section.link_select:
+			self.link_select = section.link_select
+		
+		if section.published_select:
+			self.published_select = section.published_select
+		
+		if section.soup_parser:
+			self.soup_parser = section.soup_parser
+		
+		if section.max_size:
+			self.max_size = int(section.max_size)
+		
 		exclude = section.get_list('exclude')
 		if exclude:
 			self.exclude = set(exclude)
@@ -119,13 +1026,30 @@ class Feed:
 		
 		if section.max_items:
 			self.max_items = int(section.max_items)
+		
+		if section.incremental:
+			self.incremental = int(section.incremental)
+		
+		if section.history:
+			self.history = int(section.history)
 	
 	
 	def state_file(self):
 		return self.state + '/' + self.name
 	
 	
-	def load(self):
+	def local(self):
+		return self.url.find(':') == -1 or self.url.startswith('file:')
+	
+	
+	def path(self):
+		"""File name of a local feed, given as a path or file: URL"""
+		if self.url.startswith('file:'):
+			return urllib.url2pathname(urlparse.urlsplit(self.url).path)
+		return self.url
+	
+	
+	def load(self, store):
 		
 		if not self.url:
 			raise ConfigurationError(u'Missing rss url for feed {0}'.format(self.name))
@@ -134,45 +1058,123 @@ class Feed:
 			raise ConfigurationError(
 				u'Invalid rss update interval {0} for feed {1}'.format(self.interval, self.name))
 		
-		if self.soup and (not self.title_soup) and (not self.link_soup):
+		self.posts = self.extractor(u'soup', 'page', self.soup, self.soup_select)
+		self.titles = self.extractor(u'title', 'post', self.title_soup, self.title_select)
+		self.links = self.extractor(u'link', 'post', self.link_soup, self.link_select)
+		self.published = self.extractor(u'published', 'post',
+		                                self.published_soup, self.published_select)
+		
+		if self.posts and (not self.titles) and (not self.links):
 			raise ConfigurationError(
-				u'soup requires title_soup and/or link_soup for feed {1}'.format(self.name))
+				u'soup requires title_soup and/or link_soup for feed {0}'.format(self.name))
 		
-		if os.path.exists(self.state_file()):
-			old_items = set()
-			handle = codecs.open(self.state_file(), 'r', encoding='utf-8')
-			try:
-				first = True
-				for line in handle:
-					line = line.rstrip()
-					if line:
-						if first:
-							first = False
-							self.old_time = float(line)
-						else:
-							old_items.add(unicode(line))
-				if not first:
-					self.old_items = old_items
-				
-			finally:
-				handle.close()
+		if self.adaptive:
+			if self.min_interval is None:
+				self.min_interval = min(INTERVAL, self.interval)
+			if self.max_interval is None:
+				self.max_interval = self.interval * 8
+			if self.min_interval > self.max_interval:
+				raise ConfigurationError(
+					u'rss min_interval is larger than max_interval for feed {0}'.format(self.name))
+		
+		self.arrivals = deque(maxlen=ARRIVALS)
+		self.stats = Stats()
+		
+		self.store = store
+	
+	
+	def restore(self, state):
+		"""Restore the state from the store or migrate an old state file"""
+		
+		if state is not None:
+			(row, keys) = state
+			for (key, value) in zip((u'name', u'time', u'etag', u'modified', u'digest', u'window'), row):
+				if value is not None:
+					self.load_value(key, value)
+			self.old_items = History()
+			for key in keys:
+				self.old_items.add(key)
+		elif self.state and os.path.exists(self.state_file()):
+			# One-time migration from the old per-feed state files
+			self.load_file()
+			self.save()
+			os.rename(self.state_file(), self.state_file() + '.migrated')
+			logger.info(u'{0}: Migrated state file {1}'.format(self.name, self.state_file()))
+		
+		self.loaded = True
+	
+	
+	def load_file(self):
+		
+		old_items = History()
+		handle = codecs.open(self.state_file(), 'r', encoding='utf-8')
+		try:
+			first = True
+			digests = False
+			header = (handle.readline().rstrip() == STATE_HEADER)
+			if not header:
+				handle.seek(0)
+			for line in handle:
+				line = line.rstrip()
+				if header:
+					if not line:
+						header = False
+						continue
+					(key, value) = line.split(u' ', 1)
+					self.load_value(key, value)
+					if key == u'time':
+						first = False
+					elif key == u'items':
+						digests = (value == u'md5')
+				elif line:
+					if first:
+						first = False
+						self.old_time = float(line)
+					elif digests:
+						old_items.add(str(line).decode('hex'))
+					else:
+						old_items.add(History.key(unicode(line)))
+			if not first:
+				self.old_items = old_items
+			
+		finally:
+			handle.close()
 	
 	
-	def save(self):
+	def extractor(self, option, variable, expression, selector):
+		
+		if not expression and not selector:
+			return None
+		
+		try:
+			return Extractor(variable, expression, selector)
+		except Exception as e:
+			raise ConfigurationError(u'Invalid {0} expression for feed {1}: {2}'.format(
+				option, self.name, e))
+	
+	
+	def load_value(self, key, value):
+		if key == u'time':
+			self.old_time = float(value)
+		elif key == u'etag':
+			self.etag = value
+		elif key == u'modified':
+			self.modified = float(value) if self.local() else value
+		elif key == u'digest':
+			self.digest = value
+		elif key == u'window':
+			self.window = int(value)
+	
+	
+	def save(self, keys = None, removed = ()):
 		if self.old_items is not None:
-			handle = codecs.open(self.state_file(), 'w', encoding='utf-8')
-			try:
-				handle.write(unicode(self.old_time) + u'\n')
-				for guid in self.old_items:
-					handle.write(guid + u'\n')
-			finally:
-				handle.close()
+			self.store.save(self, self.old_items if keys is None else keys, removed)
 	
 	
-	def disable(self, bot, message):
+	def disable(self, bot, message, notify = True):
 		message = u'{0}: Can\'t parse feed, disabling: {1}'.format(self.name, message)
 		logger.warning(message)
-		if self.backoff != 0:
+		if self.backoff != 0 and notify:
 			bot.msg(bot.config.core.owner, message)
 		self.backoff += self.interval + (self.backoff / 10)
 	
@@ -188,7 +1190,7 @@ class Feed:
 			if channel in self.exclude:
 				return # Excluded channel
 			
-			bot.msg(channel, message)
+			bot.memory['staticrss'].announcer.put(channel, message)
 	
 	
 	def new_item(self, bot, item):
@@ -231,154 +1233,303 @@ class Feed:
 	def agent(self, bot):
 		return u'{0}/1.0 ({1})'.format(bot.config.core.nick, bot.config.core.name)
 	
-	def update_feed(self, bot):
+	def download(self, bot):
 		
-		mtime = None
-		if self.url.find(':') == -1:
-			mtime = os.path.getmtime(self.url)
+		if self.local():
+			mtime = os.path.getmtime(self.path())
 			if self.modified and self.modified >= mtime:
-				Status = namedtuple('Status', 'status')
-				return Status(304)
+				return Response(self.url, 304, 'Not Modified', { }, '', None)
+			start = time.time()
+			handle = open(self.path(), 'rb')
+			try:
+				(body, digest, size) = read_body(handle, limit=self.max_size)
+			finally:
+				handle.close()
+			response = Response(self.url, 200, 'OK', { }, body, digest)
+			response.modified = mtime
+			response.transfer = time.time() - start
+			return response
 		
-		fp = feedparser.parse(self.url, etag=self.etag, modified=self.modified, agent=self.agent(bot))
+		headers = { 'User-Agent' : self.agent(bot) }
 		
-		# Check for malformed XML
-		if fp.bozo and not isinstance(fp.bozo_exception, feedparser.CharacterEncodingOverride):
-			raise fp.bozo_exception
+		if not self.posts:
+			headers['Accept'] = feedparser.ACCEPT_HEADER
 		
-		# Check HTTP status
-		if getattr(fp, 'status', 200) == 410: # GONE
-			raise urllib2.HTTPError(self.url, 410, 'Gone.', { }, fp)
+		if self.etag:
+			headers['If-None-Match'] = self.etag
 		
-		if mtime:
-			setattr(fp, 'modified', mtime)
+		if self.modified:
+			headers['If-Modified-Since'] = self.modified
 		
-		return fp
-	
-	@staticmethod
-	def get_text(blob):
+		ok = False
 		try:
-			return blob.get_text().strip()
-		except:
-			return blob.strip()
+			response = bot.memory['staticrss'].pool.get(self.url, headers, self.max_size)
+			ok = (response.status < 500)
+		except TooLarge:
+			ok = True
+			raise
+		finally:
+			# Right away, so that poll sees the host's failure count
+			self.release(bot, ok)
+		
+		if response.status != 200 and response.status != 304:
+			raise HTTPError(response.href, response.status, response.reason)
+		
+		return response
 	
-	def update_soup(self, bot):
+	def update_incremental(self, bot, response):
 		
-		request = urllib2.Request(self.url)
+		entries = [ ]
+		guids = [ ]
+		keys = [ ]
+		known = 0
 		
-		request.add_header('User-Agent', self.agent(bot))
+		# Keep the guids and keys so that poll doesn't have to compute them again
+		base = '' if self.local() else response.href
+		for entry in iter_entries(response.body, base):
+			entries.append(entry)
+			guids.append(self.guid(entry))
+			keys.append(History.key(guids[-1]))
+			if keys[-1] in self.old_items:
+				known += 1
+				if known >= self.incremental:
+					# The rest of the document has been seen before
+					return Record(entries=entries, guids=guids, keys=keys, complete=False)
+			else:
+				known = 0
 		
-		if self.etag and not self.modified:
-			request.add_header('If-None-Match', self.etag)
+		return Record(entries=entries, guids=guids, keys=keys)
+	
+	def update_feed(self, bot, response):
 		
-		if self.modified:
-			request.add_header('If-Modified-Since', self.modified)
+		if self.incremental and self.old_items is not None:
+			try:
+				return self.update_incremental(bot, response)
+			except SyntaxError as e:
+				logger.info(u'{0}: Incremental parsing failed, parsing whole feed: {1}'.format(
+					self.name, e))
 		
-		opener = urllib2.build_opener(DefaultErrorHandler()) 
+		# The body has already been decoded, feedparser must not inflate it again
+		headers = dict((key, value) for (key, value) in response.headers.items()
+		               if key.lower() not in ('content-encoding', 'content-length'))
+		if not self.local():
+			headers.setdefault('content-location', response.href)
 		
-		fp = opener.open(request)
+		parser = bot.memory['staticrss'].parser
+		return parser.parse(parse_feed, response.body, headers)
+	
+	def update_soup(self, bot, response):
 		
-		setattr(fp, 'entries', None)
+		specs = [ extractor.spec if extractor else None for extractor in
+		          (self.posts, self.titles, self.links, self.published) ]
 		
-		if hasattr(fp, 'status'):
-			if fp.status == 304 or fp.status == 301:
-				return
-			if fp.status != 200:
-				raise fp
+		parser = bot.memory['staticrss'].parser
+		return parser.parse(parse_soup, response.body, response.href, self.soup_parser, specs)
+	
+	@staticmethod
+	def cache_hint(response):
 		
-		page = BeautifulSoup(fp.read())
+		match = re.search(r'max-age\s*=\s*(\d+)', response.headers.get('cache-control', ''))
+		if match:
+			return int(match.group(1))
 		
-		entries = [ ]
+		expires = email.utils.parsedate_tz(response.headers.get('expires', ''))
+		if expires:
+			return max(0, int(email.utils.mktime_tz(expires) - time.time()))
 		
-		for post in eval(self.soup, {}, {"page" : page}):
-			
-			entry = feedparser.FeedParserDict()
-			
-			if self.title_soup:
-				entry['title'] = self.get_text(eval(self.title_soup, {}, {"post" : post}))
-			
-			if self.link_soup:
-				url = self.get_text(eval(self.link_soup, {}, {"post" : post}))
-				entry['link'] = urlparse.urljoin(self.url, url)
-			
-			if self.published_soup:
-				entry['published'] = self.get_text(eval(self.published_soup, {}, {"post" : post}))
-			
-			entries.append(entry)
+		return 0
+	
+	@staticmethod
+	def feed_hint(fp):
 		
-		setattr(fp, 'entries', entries)
+		channel = fp.get('feed', { })
+		hint = 0
 		
-		etag = fp.headers.get('ETag')
-		if etag:
-			setattr(fp, 'etag', etag)
+		try:
+			if channel.get('ttl'):
+				hint = int(channel.get('ttl')) * 60
+			period = UPDATE_PERIODS.get(channel.get('sy_updateperiod', '').strip())
+			if period:
+				hint = max(hint, period / max(1, int(channel.get('sy_updatefrequency', 1))))
+		except ValueError:
+			pass
+		
+		return hint
+	
+	def poll_interval(self):
+		if self.next_interval is not None:
+			return self.next_interval
+		return self.interval
+	
+	def adapt(self):
+		
+		now = time.time()
+		
+		# Poll about twice per typical gap between new items
+		wait = self.interval
+		arrivals = list(self.arrivals)
+		if len(arrivals) >= 2:
+			gaps = sorted(b - a for (a, b) in zip(arrivals, arrivals[1:]))
+			wait = gaps[len(gaps) / 2] / 2
+		
+		# Slow down while nothing happens
+		last = arrivals[-1] if arrivals else self.old_time
+		if last:
+			wait = max(wait, (now - last) / 2)
 		
-		modified = fp.headers.get('Last-Modified')
-		if modified:
-			setattr(fp, 'modified', modified)
+		# Don't poll before the server or feed wants us to
+		wait = max(wait, min(max(self.expires, self.ttl), self.max_interval))
 		
-		return fp
+		wait = int(min(max(wait, self.min_interval), self.max_interval))
+		if wait != self.poll_interval():
+			logger.info(u'{0}: Poll interval {1} -> {2}'.format(
+				self.name, self.poll_interval(), wait))
+		self.next_interval = wait
 	
-	def update(self, bot, elapsed_seconds):
+	def update(self, bot, elapsed_seconds, force = False):
+		
+		# Don't announce anything before we know which items are old
+		if not self.loaded:
+			return False
 		
 		# Support per-feed update interval
 		self.age += elapsed_seconds
-		if self.age < self.interval + self.backoff:
+		wait = self.poll_interval()
+		if self.age < wait + self.backoff and not force:
 			return False
-		self.age = self.age % self.interval
+		
+		# Skip feeds on hosts that are down
+		if not self.local():
+			hosts = bot.memory['staticrss'].hosts
+			self.host = hosts.get(self.url)
+			if not hosts.acquire(self.host):
+				return False
+			self.acquired = True
+		
+		try:
+			
+			self.age = self.age % wait
+			
+			self.poll(bot)
+			
+			if self.adaptive:
+				self.adapt()
+			
+		finally:
+			# In case poll failed before download could report to the host
+			self.release(bot, None)
+		
+		return True
+	
+	def release(self, bot, ok):
+		"""Report the outcome of a fetch to the host's circuit breaker, once per update"""
+		if not self.acquired:
+			return
+		self.acquired = False
+		message = bot.memory['staticrss'].hosts.release(self.host, ok)
+		if message:
+			logger.warning(message)
+			bot.msg(bot.config.core.owner, message)
+	
+	def report(self):
+		# Configured interval, the adaptive one and the one actually achieved
+		return self.stats.report(self.name, self.skipped_parses, self.backoff,
+		                         self.interval, self.poll_interval())
+	
+	def poll(self, bot):
+		
+		self.stats.poll()
 		
 		# Download feed snapshot
 		try:
-			if self.soup:
-				fp = self.update_soup(bot)
-			else:
-				fp = self.update_feed(bot)
-		except urllib2.HTTPError as e:
-			self.disable(bot, str(e))
-			return True
+			response = self.download(bot)
 		except IOError as e:
-			self.disable(bot, str(e))
-			return True
+			self.stats.errors += 1
+			# Failing hosts are reported once for all their feeds
+			self.disable(bot, str(e), self.local() or self.host.failures == 0)
+			return
+		except TooLarge as e:
+			self.stats.errors += 1
+			self.disable(bot, unicode(e))
+			return
 		except Exception as e:
+			self.stats.errors += 1
 			self.disable(bot, traceback.format_exc(e))
-			return True
+			return
 		
-		# fp.status will only exist if pulling from an online feed
-		status = getattr(fp, 'status', 200)
+		self.stats.fetched(response)
 		
-		self.backoff = 0
+		status = response.status
+		self.expires = self.cache_hint(response)
 		
 		# Check HTTP status
-		if status == 301 and hasattr(fp, 'href'): # MOVED_PERMANENTLY
+		if response.moved: # MOVED_PERMANENTLY
 			logger.warning(u'{0}: status = 301 (Moved Permanently), updating URI to {1}'.format(
-				self.name, fp.href))
-			self.url = fp.href
+				self.name, response.href))
+			self.url = response.href
 		if status == 304: # NOT MODIFIED
 			logger.info(u'{0}: status = 304 (Not Modified)'.format(self.name))
-			return True
+			self.stats.not_modified += 1
+			self.backoff = 0
+			return
 		
 		# Check if anything changed
-		new_etag = fp.etag if hasattr(fp, 'etag') else None
+		new_etag = response.etag
 		if new_etag is not None and new_etag == self.etag:
 			logger.info(u'{0}: Same etag: {1}'.format(self.name, new_etag))
-			return True
-		new_modified = fp.modified if hasattr(fp, 'modified') else None
+			self.stats.unchanged += 1
+			self.backoff = 0
+			return
+		new_modified = response.modified
 		if new_modified is not None and new_modified == self.modified:
 			logger.info(u'{0}: Same modification time: {1}'.format(
 				self.name, new_modified))
-			return True
+			self.stats.unchanged += 1
+			self.backoff = 0
+			return
+		if self.digest is not None and response.digest == self.digest:
+			self.skipped_parses += 1
+			logger.info(u'{0}: Same content hash: {1} ({2} parses skipped)'.format(
+				self.name, response.digest, self.skipped_parses))
+			self.etag = new_etag
+			self.modified = new_modified
+			self.backoff = 0
+			return
+		
+		# Parse feed snapshot
+		start = time.time()
+		try:
+			if self.posts:
+				fp = self.update_soup(bot, response)
+			else:
+				fp = self.update_feed(bot, response)
+		except Exception as e:
+			self.stats.errors += 1
+			self.disable(bot, traceback.format_exc(e))
+			return
+		self.stats.parsed(self.posts, time.time() - start, len(fp.entries))
+		
+		self.backoff = 0
+		self.ttl = self.feed_hint(fp)
 		
 		logger.info(u'{0}: status = {1}, items = {2}, etag = {3}, time = {4}'.format(
 			self.name, status, len(fp.entries), new_etag, new_modified))
 		
 		# Check for new items
+		if 'keys' in fp:
+			guids = fp['guids'][::-1]
+			keys = fp['keys'][::-1]
+		else:
+			guids = [ self.guid(item) for item in reversed(fp.entries) ]
+			keys = [ History.key(guid) for guid in guids ]
 		new_items = (self.old_items is None)
 		if fp.entries and self.old_items is not None:
 			skipped = -self.max_items
-			for item in reversed(fp.entries):
-				guid = self.guid(item)
-				if guid in self.old_items:
+			for (item, guid, key) in zip(reversed(fp.entries), guids, keys):
+				if key in self.old_items:
 					continue
 				new_items = True
+				self.stats.new_items += 1
 				if 'published_parsed' in item:
 					new_time = time.mktime(item.published_parsed)
 					if new_time <= self.old_time:
@@ -393,29 +1544,275 @@ class Feed:
 				self.msg(bot, u'(and one more item)')
 			elif skipped > 0:
 				self.msg(bot, u'(and {0} more items)'.format(skipped))
+			if new_items:
+				self.arrivals.append(time.time())
+		
+		# Update the last update time
+		changed = (new_etag != self.etag or new_modified != self.modified
+		           or response.digest != self.digest)
+		self.etag = new_etag
+		self.modified = new_modified
+		self.digest = response.digest
 		
 		# Update the known items list
 		if new_items:
-			self.old_items = set()
-			for item in reversed(fp.entries):
-				self.old_items.add(self.guid(item))
+			if self.old_items is None:
+				self.old_items = History()
+			for key in keys:
+				self.old_items.add(key)
+			# Never forget items that are still in the current document
+			if fp.get('complete', True):
+				self.window = len(keys)
+			removed = self.old_items.trim(max(self.history, self.window))
 			if fp.entries and 'published_parsed' in fp.entries[0]:
 				self.old_time = max(self.old_time, time.mktime(fp.entries[0].published_parsed))
-			self.save()
 		
-		# Update the last update time
-		self.etag = new_etag
-		self.modified = new_modified
-		
-		return True
+		# Remember the validators and content hash across restarts
+		if new_items:
+			self.save(keys, removed)
+		elif changed:
+			self.save([ ])
+
+
+class Announcer:
+	"""Per-channel announcement queues, sent by a background thread"""
+	
+	def __init__(self, bot, delay, batch):
+		self.bot = bot
+		self.delay = delay
+		self.batch = batch
+		self.queues = { } # channel -> deque of messages
+		self.ready = { } # channel -> earliest time for the next line
+		self.condition = threading.Condition()
+		self.running = True
+		self.thread = None
+	
+	
+	def put(self, channel, message):
+		with self.condition:
+			self.queues.setdefault(channel, deque()).append(message)
+			self.condition.notify()
+	
+	
+	def line(self, queue):
+		line = queue.popleft()
+		if self.batch:
+			while queue and len(line) + len(SEPARATOR) + len(queue[0]) <= MAX_LINE_LENGTH:
+				line += SEPARATOR + queue.popleft()
+		return line
+	
+	
+	def next(self):
+		with self.condition:
+			while True:
+				now = time.time()
+				wait = None
+				for (channel, queue) in self.queues.items():
+					if not queue:
+						del self.queues[channel]
+						continue
+					ready = self.ready.get(channel, 0)
+					if ready <= now or not self.running:
+						self.ready[channel] = now + self.delay
+						return (channel, self.line(queue))
+					wait = ready - now if wait is None else min(wait, ready - now)
+				if not self.running:
+					return None
+				self.condition.wait(wait)
+	
+	
+	def run(self):
+		while True:
+			message = self.next()
+			if message is None:
+				return
+			(channel, line) = message
+			try:
+				self.bot.msg(channel, line)
+			except Exception as e:
+				logger.warning(u'Can\'t send announcement to {0}: {1}'.format(
+					channel, traceback.format_exc(e)))
+	
+	
+	def start(self):
+		if self.thread is not None:
+			return
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	
+	def stop(self):
+		if self.thread is None:
+			return
+		# Signal the thread to send what is left and exit
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.thread.join()
+
+
+class Watcher:
+	"""Updates local feeds right after their file was written, using inotify"""
+	
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+	IN_CLOEXEC = 0x00080000
+	EVENT = struct.Struct('iIII')
+	
+	def __init__(self, bot, data, feeds, debounce):
+		self.bot = bot
+		self.data = data
+		self.debounce = debounce
+		self.files = { } # (watch, file name) -> [ feeds ]
+		self.pending = { } # feed -> time of the last write
+		self.thread = None
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		(self.wakeup, self.stopper) = os.pipe()
+		watches = { }
+		for feed in feeds:
+			(directory, name) = os.path.split(os.path.abspath(feed.path()))
+			if directory not in watches:
+				watch = libc.inotify_add_watch(self.fd, directory,
+				                               self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+				if watch < 0:
+					logger.warning(u'{0}: Can\'t watch {1}, polling only'.format(feed.name, directory))
+					continue
+				watches[directory] = watch
+			self.files.setdefault((watches[directory], name), [ ]).append(feed)
+	
+	
+	def read_events(self):
+		data = os.read(self.fd, 64 * 1024)
+		offset = 0
+		while offset < len(data):
+			(watch, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+			offset += self.EVENT.size
+			name = data[offset:offset + length].rstrip('\0')
+			offset += length
+			for feed in self.files.get((watch, name), [ ]):
+				self.pending[feed] = time.time()
+	
+	
+	def run(self):
+		while True:
+			
+			timeout = None
+			if self.pending:
+				timeout = max(0, min(self.pending.values()) + self.debounce - time.time())
+			
+			(ready, _, _) = select.select([ self.fd, self.wakeup ], [ ], [ ], timeout)
+			if self.wakeup in ready:
+				return
+			if self.fd in ready:
+				self.read_events()
+			
+			# Update feeds whose file has not been written for a while
+			now = time.time()
+			for (feed, written) in self.pending.items():
+				if now - written < self.debounce:
+					continue
+				if not feed.loaded:
+					# Try again once the state of the feed has been loaded
+					self.pending[feed] = now
+					continue
+				del self.pending[feed]
+				try:
+					with self.data.lock:
+						feed.update(self.bot, 0, force=True)
+				except Exception as e:
+					logger.warning(u'{0}: Update after write failed: {1}'.format(
+						feed.name, traceback.format_exc(e)))
+	
+	
+	def start(self):
+		if self.thread is not None:
+			return
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	
+	def stop(self):
+		if self.thread is not None:
+			os.write(self.stopper, 'x')
+			self.thread.join()
+		os.close(self.fd)
+		os.close(self.wakeup)
+		os.close(self.stopper)
 
 
 class Feeds:
 	
-	def __init__(self, feeds):
+	def __init__(self, feeds, pool, hosts, store, announcer, parser):
 		self.feeds = feeds
+		self.pool = pool
+		self.parser = parser
+		self.hosts = hosts
+		self.store = store
+		self.announcer = announcer
+		self.watcher = None
+		self.stats_file = None
+		self.stats_written = time.time()
 		self.next = 0
 		self.lock = threading.Lock()
+		self.loader = None
+	
+	
+	def load(self):
+		"""Restore the state of all feeds, called in the background after setup"""
+		
+		start = time.time()
+		
+		try:
+			states = self.store.load()
+		except Exception as e:
+			logger.error(u'Can\'t load rss state: {0}'.format(e))
+			states = { }
+		
+		for feed in self.feeds:
+			try:
+				feed.restore(states.get(feed.name))
+			except Exception as e:
+				logger.warning(u'{0}: Can\'t load state: {1}'.format(feed.name, e))
+				feed.old_items = None
+				feed.loaded = True
+			logger.info(u'{0}: {1} {2} @{3} #={4} >={5}'.format(
+				u'Soup' if feed.posts else u'Feed',
+				feed.name, feed.url, feed.interval,
+				len(feed.old_items) if feed.old_items is not None else None, feed.old_time))
+		
+		logger.info(u'Loaded state of {0} feeds in {1:.2f}s'.format(
+			len(self.feeds), time.time() - start))
+	
+	
+	def start(self):
+		self.loader = threading.Thread(target=self.load, name='staticrss-load')
+		self.loader.daemon = True
+		self.loader.start()
+	
+	
+	def report(self):
+		total = Stats()
+		for feed in self.feeds:
+			total.add(feed.stats)
+		skipped = sum(feed.skipped_parses for feed in self.feeds)
+		return total.report(u'(all)', skipped, None, None, None)
+	
+	
+	def write_stats(self):
+		self.stats_written = time.time()
+		handle = codecs.open(self.stats_file + '.tmp', 'w', encoding='utf-8')
+		try:
+			handle.write(self.report() + u'\n')
+			for feed in sorted(self.feeds, key=lambda feed: feed.name):
+				handle.write(feed.report() + u'\n')
+		finally:
+			handle.close()
+		os.rename(self.stats_file + '.tmp', self.stats_file)
 
 
 def setup(bot):
@@ -444,14 +1841,81 @@ def setup(bot):
 			
 			feeds.append(feed)
 	
+	store = bot.config.rss.store
+	if not store:
+		if not defaults.state:
+			raise ConfigurationError(u'Missing rss state directory')
+		store = defaults.state + '/' + STORE
+	store = Store(store)
+	
+	# Validate the config now, the state is loaded in the background
 	for feed in feeds:
-		feed.load()
-		logger.info(u'{0}: {1} {2} @{3} #={4} >={5}'.format(
-			u'Soup' if feed.soup else u'Feed',
-			feed.name, feed.url, feed.interval,
-			len(feed.old_items) if feed.old_items is not None else None, feed.old_time))
+		feed.load(store)
+	
+	max_connections = MAX_CONNECTIONS
+	if bot.config.rss.max_connections:
+		max_connections = int(bot.config.rss.max_connections)
+	
+	idle_timeout = IDLE_TIMEOUT
+	if bot.config.rss.idle_timeout:
+		idle_timeout = int(bot.config.rss.idle_timeout)
+	
+	send_delay = SEND_DELAY
+	if bot.config.rss.send_delay:
+		send_delay = float(bot.config.rss.send_delay)
+	
+	batch = True
+	if bot.config.rss.batch is not None:
+		batch = bool(bot.config.rss.batch)
+	
+	parse_processes = 0
+	if bot.config.rss.parse_processes:
+		parse_processes = int(bot.config.rss.parse_processes)
+	
+	parse_timeout = PARSE_TIMEOUT
+	if bot.config.rss.parse_timeout:
+		parse_timeout = float(bot.config.rss.parse_timeout)
+	
+	parser = Parser(parse_processes, parse_timeout)
+	
+	# Fork the parser workers before starting any threads of our own
+	parser.start()
+	
+	announcer = Announcer(bot, send_delay, batch)
+	announcer.start()
+	
+	host_failures = HOST_FAILURES
+	if bot.config.rss.host_failures:
+		host_failures = int(bot.config.rss.host_failures)
 	
-	bot.memory['staticrss'] = Feeds(feeds)
+	host_backoff = HOST_BACKOFF
+	if bot.config.rss.host_backoff:
+		host_backoff = int(bot.config.rss.host_backoff)
+	
+	max_host_backoff = MAX_HOST_BACKOFF
+	if bot.config.rss.max_host_backoff:
+		max_host_backoff = int(bot.config.rss.max_host_backoff)
+	
+	hosts = Hosts(host_failures, host_backoff, max_host_backoff)
+	
+	data = Feeds(feeds, HTTPPool(max_connections, idle_timeout), hosts, store, announcer, parser)
+	
+	local = [ feed for feed in feeds if feed.local() ]
+	if local and bot.config.rss.watch is not False:
+		debounce = DEBOUNCE
+		if bot.config.rss.debounce:
+			debounce = float(bot.config.rss.debounce)
+		try:
+			data.watcher = Watcher(bot, data, local, debounce)
+			data.watcher.start()
+		except (OSError, AttributeError) as e:
+			logger.info(u'Can\'t watch local feeds, polling only: {0}'.format(e))
+	
+	data.stats_file = bot.config.rss.stats
+	
+	bot.memory['staticrss'] = data
+	
+	data.start()
 
 
 @interval(INTERVAL)
@@ -461,21 +1925,59 @@ def update_feeds(bot):
 	
 	with data.lock:
 		
+		if data.stats_file and time.time() - data.stats_written >= STATS_INTERVAL:
+			try:
+				data.write_stats()
+			except Exception as e:
+				logger.warning(u'Can\'t write stats file {0}: {1}'.format(data.stats_file, e))
+		
 		for i in [(i + data.next) % len(data.feeds) for i in range(len(data.feeds))]:
 			data.next = i + 1
 			if data.feeds[i].update(bot, INTERVAL):
 				return
 
 
+@commands('rssstats')
+@priority('low')
+def rssstats(bot, trigger):
+	"""Show fetch and parse statistics for one feed or for the most expensive feeds"""
+	
+	if not trigger.admin:
+		return
+	
+	data = bot.memory['staticrss']
+	name = trigger.group(2)
+	
+	# No data.lock: it is held for whole fetches, and slightly stale counters are fine
+	if name:
+		lines = [ feed.report() for feed in data.feeds if feed.name == name.strip() ]
+		if not lines:
+			lines = [ u'Unknown feed: {0}'.format(name.strip()) ]
+	else:
+		feeds = sorted(data.feeds, key=lambda feed: feed.stats.cost(), reverse=True)
+		lines = [ data.report() ] + [ feed.report() for feed in feeds[:STATS_TOP] ]
+	
+	for line in lines:
+		bot.say(line)
+
+
 def shutdown(bot):
 	
 	data = bot.memory['staticrss']
 	
+	if data.watcher is not None:
+		data.watcher.stop()
+	
+	if data.loader is not None:
+		data.loader.join()
+	
 	with data.lock:
 		
-		for feed in data.feeds:
-			try:
-				feed.save()
-			except Exception as e:
-				logger.warning('{0}: Can\'t save feed state: {1}'.format(
-					feed.name, traceback.format_exc(e)))
+		# Feed state is committed to the store after every change
+		data.store.close()
+		
+		data.pool.close()
+		
+		data.parser.close()
+	
+	data.announcer.stop()